@@ -0,0 +1,78 @@
+"""
+Measures how long gatari.py takes to start for commands that shouldn't need the heavy
+dependencies, and checks which of those dependencies each command actually imported.
+
+Commands are run against an empty scratch root, so the time is almost all interpreter
+startup and imports. For comparison, the cost of importing each heavy dependency that
+is installed is measured too.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Set, Tuple
+
+HEAVY_MODULES = ["av", "PIL", "azure", "jinja2", "tqdm"]
+SCRIPT = Path(__file__).parent / "gatari.py"
+
+COMMANDS = [
+    ["--help"],
+    ["extract-attachments"],
+    ["process-subs"],
+    ["index"],
+    ["query", "hello"],
+]
+
+def run_timed(args: List[str]) -> Tuple[float, Set[str]]:
+    """
+    Runs a python command with -X importtime, returning the wall time in seconds
+    and which heavy top level modules were imported
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args,
+        capture_output=True, text=True, check=False)
+    elapsed = time.perf_counter() - start
+
+    imported = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            module = line.rsplit("|", 1)[1].strip().split(".")[0]
+            if module in HEAVY_MODULES:
+                imported.add(module)
+    return elapsed, imported
+
+def main():
+    """
+    Runs each command repeatedly, and prints the median startup time
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10, help="Number of times to run each command")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        (Path(root) / "source").mkdir()
+        (Path(root) / "source" / "Episodes.csv").write_text(
+            "File Name,Series Order,Series Name,Episode Number,Overall Order\n", encoding="utf8")
+        subprocess.run([sys.executable, str(SCRIPT), "--root", root, "index"], capture_output=True, check=True)
+
+        print(f"{'command':<40} {'median ms':>10}  heavy imports")
+        for command in COMMANDS:
+            results = [run_timed([str(SCRIPT), "--root", root] + command) for _ in range(args.runs)]
+            median = statistics.median(r[0] for r in results) * 1000
+            imported = set().union(*(r[1] for r in results))
+            print(f"{' '.join(command):<40} {median:>10.1f}  {', '.join(sorted(imported)) or 'none'}")
+
+    print()
+    print(f"{'import':<40} {'median ms':>10}")
+    for module in HEAVY_MODULES:
+        if subprocess.run([sys.executable, "-c", f"import {module}"], capture_output=True, check=False).returncode:
+            print(f"{module:<40} {'not installed':>10}")
+            continue
+        results = [run_timed(["-c", f"import {module}"]) for _ in range(args.runs)]
+        print(f"{module:<40} {statistics.median(r[0] for r in results) * 1000:>10.1f}")
+
+if __name__ == "__main__":
+    main()
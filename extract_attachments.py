@@ -7,11 +7,7 @@ import json
 from pathlib import Path
 import subprocess
 from typing import Any, List
-from models import EpisodeInfo
-ROOT_PATH = Path("/mnt/e/gatari_lines")
-SOURCE_PATH = ROOT_PATH / Path("source")
-EPISODES_FILE = SOURCE_PATH / "Episodes.csv"
-OUTPUT_PATH = ROOT_PATH / Path("mediainfo")
+from models import EpisodeInfo, PipelinePaths
 FONT_TYPES = ["application/x-truetype-font", "application/vnd.ms-opentype", "font/ttf", "font/otf"]
 
 SUB_MAP = {
@@ -78,12 +74,12 @@ def extract_subtitles(episode_info: EpisodeInfo, media_info: Any):
     with open(episode_info.episode_path / 'subs.json', "w", encoding="utf8") as out_file:
         json.dump(sub_map, out_file, indent=2)
 
-def load_episodes() -> List[EpisodeInfo]:
+def load_episodes(paths: PipelinePaths) -> List[EpisodeInfo]:
     """
     Reads Episodes.csv and returns a list of episode info dataclasses
     """
     all_lines: List[EpisodeInfo] = []
-    with open(EPISODES_FILE, "r", encoding="utf8") as in_csv:
+    with open(paths.episodes_file, "r", encoding="utf8") as in_csv:
         reader = csv.DictReader(in_csv)
 
         for line in reader:
@@ -93,8 +89,8 @@ def load_episodes() -> List[EpisodeInfo]:
                 line["Series Name"],
                 int(line["Episode Number"]),
                 int(line["Overall Order"]),
-                SOURCE_PATH / line["File Name"],
-                OUTPUT_PATH / path.basename(path.splitext(line["File Name"])[0])
+                paths.source / line["File Name"],
+                paths.mediainfo / path.basename(path.splitext(line["File Name"])[0])
             ))
     return all_lines
 
@@ -121,16 +117,16 @@ def process_episode(episode_info: EpisodeInfo):
         json.dump(episode_info.as_json_dict(), out_file, indent=2)
     (episode_info.episode_path / '.completed').touch()
 
-def main():
+def main(paths: PipelinePaths):
     """
     Reads from an Episodes.csv found the the source directory, and then runs
     mkvmerge to extract the media info and attachments from the file, and saves
     them to a per-episode path in the mediainfo directory
     """
-    episodes = load_episodes()
+    episodes = load_episodes(paths)
 
     for i in episodes:
         process_episode(i)
 
 if __name__ == "__main__":
-    main()
+    main(PipelinePaths.from_root())
@@ -0,0 +1,32 @@
+"""
+Tracks whether a file has changed since a previous run, so scripts that derive output from
+frame_info.json files only redo the ones that changed
+"""
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+def hash_file(file_path: Path) -> str:
+    """
+    Returns the SHA-1 of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def check_file(file_path: Path, previous: Optional[Dict[str, Any]]) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Compares a file to the state recorded for it on a previous run (None if there wasn't one).
+    Returns whether its contents changed, along with its current mtime_ns, size and sha1 to
+    record for next time. The file is only hashed if its modification time or size differ
+    """
+    stat = file_path.stat()
+    state: Dict[str, Any] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    if previous and previous["mtime_ns"] == stat.st_mtime_ns and previous["size"] == stat.st_size:
+        return False, {**state, "sha1": previous["sha1"]}
+
+    # Touched but not changed still counts as unchanged, just with a new timestamp
+    state["sha1"] = hash_file(file_path)
+    return previous is None or previous["sha1"] != state["sha1"], state
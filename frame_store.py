@@ -0,0 +1,266 @@
+"""
+Exports all frame_info.json files to a single memory mapped file of fixed-width records,
+sorted the same way load_to_azure.py orders the table, and serves lookups from it over HTTP.
+
+The service returns the same entities the bot reads from the Azure table, so the bot (and tests)
+can be pointed at it instead. Moving to the next line is just the next record in the file, rather
+than a round trip following NextPartitionKey/NextRowKey.
+"""
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+import glob
+import json
+import mmap
+import os
+from pathlib import Path
+import random
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from models import ExtractedFrame, PipelinePaths
+
+STORE_VERSION = 2
+STORE_MAGIC = b"GLFS"
+# magic, version, record count
+HEADER = struct.Struct("<4sII")
+# overall order, series order, episode number, extracted ms, then an offset and length into
+# the string table for each of STRING_FIELDS. Extracted ms is kept as the same float that
+# load_to_azure.py stores in the table
+STRING_FIELDS = ("partition_key", "row_key", "series_name", "frame_path", "text", "extracted")
+RECORD = struct.Struct(f"<3H2xd{len(STRING_FIELDS) * 2}I")
+
+def load_all_frames(frame_path: Path) -> List[ExtractedFrame]:
+    """
+    Loads every frame_info.json, sorted by overall order and then when the frame was extracted
+    """
+    all_frames: List[ExtractedFrame] = []
+    for frameinfo_filename in glob.glob(path.join(frame_path, "**", "frame_info.json")):
+        with open(frameinfo_filename, "r", encoding="utf8") as frameinfo_file:
+            all_frames += [ExtractedFrame.from_json_dict(l) for l in json.load(frameinfo_file)]
+    return sorted(all_frames, key=lambda f: (f.overall_order, f.extracted_ms))
+
+def export_frames(paths: PipelinePaths):
+    """
+    Writes all frames to the store file as fixed-width records followed by a string table
+    """
+    store_file = paths.store_file
+    frames = load_all_frames(paths.frames)
+    strings = bytearray()
+    records = bytearray()
+
+    for frame in frames:
+        string_refs: List[int] = []
+        for field in STRING_FIELDS:
+            encoded = str(getattr(frame, field)).encode("utf8")
+            string_refs += [len(strings), len(encoded)]
+            strings += encoded
+        records += RECORD.pack(
+            frame.overall_order,
+            frame.series_order,
+            frame.episode_number,
+            frame.extracted_ms,
+            *string_refs)
+
+    temp_file = store_file.with_suffix(".tmp")
+    with open(temp_file, "wb") as out_file:
+        out_file.write(HEADER.pack(STORE_MAGIC, STORE_VERSION, len(frames)))
+        out_file.write(records)
+        out_file.write(strings)
+    os.replace(temp_file, store_file)
+    print(f"Wrote {len(frames)} frames to {store_file}")
+
+class FrameStore:
+    """
+    Read-only view of an exported store file. Records are looked up by position in the file.
+    Lookups by table key go through a dict from keys to positions that is built when the
+    store is opened, rather than an index stored in the file, which is quick enough for the
+    tens of thousands of lines in the series
+    """
+    def __init__(self, store_file: Path):
+        with open(store_file, "rb") as in_file:
+            self._data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count = HEADER.unpack_from(self._data, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            self.close()
+            raise ValueError(f"{store_file} is not a version {STORE_VERSION} frame store, export it again")
+        if self.count == 0:
+            self.close()
+            raise ValueError(f"{store_file} has no frames")
+
+        self._strings = HEADER.size + self.count * RECORD.size
+        self._positions: Dict[Tuple[str, str], int] = {
+            self.key(i): i for i in range(self.count)
+        }
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps the store file
+        """
+        self._data.close()
+
+    def _record(self, position: int) -> Tuple[Any, ...]:
+        return RECORD.unpack_from(self._data, HEADER.size + position * RECORD.size)
+
+    def _string(self, record: Tuple[Any, ...], field: int) -> str:
+        offset, length = record[4 + field * 2:6 + field * 2]
+        return self._data[self._strings + offset:self._strings + offset + length].decode("utf8")
+
+    def key(self, position: int) -> Tuple[str, str]:
+        """
+        Returns the partition and row key of the record at a position
+        """
+        record = self._record(position)
+        return self._string(record, 0), self._string(record, 1)
+
+    def position(self, partition_key: str, row_key: str) -> Optional[int]:
+        """
+        Returns the position of the record with the given keys, if there is one
+        """
+        return self._positions.get((partition_key, row_key))
+
+    def next_position(self, position: int) -> int:
+        """
+        Returns the position after this one, wrapping around to the first record
+        """
+        return (position + 1) % self.count
+
+    def random_position(self) -> int:
+        """
+        Returns the position of a random record
+        """
+        return random.randrange(self.count)
+
+    def entity(self, position: int) -> Dict[str, Any]:
+        """
+        Returns the record at a position, in the same shape as the entities load_to_azure.py writes
+        """
+        record = self._record(position)
+        partition_key, row_key, series_name, frame_path, text, extracted = (
+            self._string(record, i) for i in range(len(STRING_FIELDS)))
+        next_partition_key, next_row_key = self.key(self.next_position(position))
+        return {
+            'PartitionKey': partition_key,
+            'RowKey': row_key,
+            'Order': record[0],
+            'Series': series_name,
+            'Episode': record[2],
+            'Frame': 'frames/' + frame_path,
+            'Lines': text,
+            'Time': extracted,
+            'Time_ms': record[3],
+            'NextPartitionKey': next_partition_key,
+            'NextRowKey': next_row_key,
+        }
+
+class FrameStoreServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the store, and the position of the current line
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], store: FrameStore, start_position: int = 0):
+        super().__init__(address, FrameStoreHandler)
+        self.store = store
+        self.current = start_position
+        self.lock = threading.Lock()
+
+class FrameStoreHandler(BaseHTTPRequestHandler):
+    """
+    Serves lookups from the store as JSON:
+
+    - /current - the current line
+    - /next - advances to the next line and returns it, or with PartitionKey and RowKey
+      parameters returns the line after that one without changing the current line
+    - /by_key?PartitionKey=...&RowKey=... - a specific line
+    - /random - a random line
+    """
+    server: FrameStoreServer
+    # HTTP/1.1 keeps connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """
+        Routes a GET request to the matching lookup
+        """
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        store = self.server.store
+        has_key = "PartitionKey" in params and "RowKey" in params
+
+        position: Optional[int] = None
+        if url.path == "/current":
+            position = self.server.current
+        elif url.path == "/next" and has_key:
+            position = store.position(params["PartitionKey"], params["RowKey"])
+            if position is not None:
+                position = store.next_position(position)
+        elif url.path == "/next":
+            with self.server.lock:
+                self.server.current = position = store.next_position(self.server.current)
+        elif url.path == "/by_key" and has_key:
+            position = store.position(params["PartitionKey"], params["RowKey"])
+        elif url.path == "/by_key":
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": "PartitionKey and RowKey are required"})
+            return
+        elif url.path == "/random":
+            position = store.random_position()
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown lookup {url.path}"})
+            return
+
+        if position is None:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "No line with that key"})
+        else:
+            self.send_json(HTTPStatus.OK, store.entity(position))
+
+    def send_json(self, status: HTTPStatus, body: Any):
+        """
+        Sends a JSON response with a Content-Length, so the connection can be reused
+        """
+        encoded = json.dumps(body, ensure_ascii=False).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+def serve(paths: PipelinePaths, host: str, port: int, start_key: Optional[Tuple[str, str]] = None):
+    """
+    Serves lookups from the store file until interrupted
+    """
+    store_file = paths.store_file
+    with FrameStore(store_file) as store:
+        start_position = 0
+        if start_key:
+            start_position = store.position(*start_key)
+            if start_position is None:
+                raise ValueError(f"No line with key {start_key}")
+        with FrameStoreServer((host, port), store, start_position) as server:
+            print(f"Serving {len(store)} lines from {store_file} on http://{host}:{server.server_port}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+def main():
+    """
+    Exports or serves the frame store from the command line
+    """
+    import gatari # pylint: disable=import-outside-toplevel
+    gatari.main(names=["export-store", "serve"], description="Exports frames to a local store, and serves lines from it")
+
+if __name__ == "__main__":
+    main()
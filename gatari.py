@@ -0,0 +1,186 @@
+"""
+Single entry point for every step of the pipeline.
+
+Each subcommand imports the script it runs only when it is invoked, so commands
+that only deal with subtitles or text don't pay for importing PyAV, Azure or Jinja.
+"""
+# pylint: disable=import-outside-toplevel
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+from models import PipelinePaths
+
+def extract_attachments_command(paths: PipelinePaths, _: argparse.Namespace):
+    """
+    Runs extract_attachments.py
+    """
+    import extract_attachments
+    extract_attachments.main(paths)
+
+def process_subs_command(paths: PipelinePaths, _: argparse.Namespace):
+    """
+    Runs process_subs.py
+    """
+    import process_subs
+    process_subs.main(paths)
+
+def grab_frames_command(paths: PipelinePaths, _: argparse.Namespace):
+    """
+    Runs grab_frames.py
+    """
+    import grab_frames
+    grab_frames.main(paths)
+
+def preview_command(paths: PipelinePaths, args: argparse.Namespace):
+    """
+    Runs generate_preview_html.py
+    """
+    import generate_preview_html
+    generate_preview_html.main(paths, args.force, args.jobs)
+
+def index_command(paths: PipelinePaths, args: argparse.Namespace):
+    """
+    Brings the line index up to date
+    """
+    import line_index
+    line_index.build_index(paths, args.force)
+
+def query_command(paths: PipelinePaths, args: argparse.Namespace):
+    """
+    Queries the line index
+    """
+    import line_index
+    line_index.query(paths, args.text, args.limit, args.json)
+
+def export_store_command(paths: PipelinePaths, _: argparse.Namespace):
+    """
+    Exports frames to the local frame store
+    """
+    import frame_store
+    frame_store.export_frames(paths)
+
+def serve_command(paths: PipelinePaths, args: argparse.Namespace):
+    """
+    Serves lines from the local frame store
+    """
+    import frame_store
+    frame_store.serve(paths, args.host, args.port, tuple(args.start) if args.start else None)
+
+def load_azure_command(paths: PipelinePaths, _: argparse.Namespace):
+    """
+    Runs load_to_azure.py
+    """
+    import load_to_azure
+    load_to_azure.main(paths)
+
+def worker_command(paths: PipelinePaths, args: argparse.Namespace):
+    """
+    Works through a stage's episodes, sharing them with workers on other machines
+    """
+    import work_queue
+    work_queue.run_workers(args.stage, paths, args.workers)
+
+def preview_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the arguments of the preview command
+    """
+    parser.add_argument("--force", action="store_true", help="Regenerate every page, even if unchanged")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of episodes to render in parallel")
+
+def index_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the arguments of the index command
+    """
+    parser.add_argument("--force", action="store_true", help="Reindex every episode")
+
+def query_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the arguments of the query command
+    """
+    parser.add_argument("text", help="Text to search for")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of results")
+    parser.add_argument("--json", action="store_true", help="Output results as JSON")
+
+def serve_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the arguments of the serve command
+    """
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--start", nargs=2, metavar=("PARTITION_KEY", "ROW_KEY"),
+        help="Key of the line to start from, instead of the first")
+
+def worker_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the arguments of the worker command
+    """
+    parser.add_argument("stage", choices=["extract-attachments", "process-subs", "grab-frames"])
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes to run on this machine")
+
+def no_arguments(_: argparse.ArgumentParser):
+    """
+    For commands that take no arguments of their own
+    """
+
+@dataclass(frozen=True)
+class Command:
+    """
+    A subcommand, along with the function that adds its arguments and the one that runs it
+    """
+    help: str
+    add_arguments: Callable[[argparse.ArgumentParser], None]
+    handler: Callable[[PipelinePaths, argparse.Namespace], None]
+
+# Every subcommand, in the order they are listed in --help. The individual scripts build their
+# command lines from these too, so each command's arguments are only defined here
+COMMANDS: Dict[str, Command] = {
+    "extract-attachments": Command("Extract subtitles and fonts from the episodes in Episodes.csv",
+        no_arguments, extract_attachments_command),
+    "process-subs": Command("Clean up extracted subtitles", no_arguments, process_subs_command),
+    "grab-frames": Command("Save a frame for every subtitle line", no_arguments, grab_frames_command),
+    "preview": Command("Generate HTML previews of extracted frames", preview_arguments, preview_command),
+    "index": Command("Index the text of every extracted line", index_arguments, index_command),
+    "query": Command("Find frames containing a line", query_arguments, query_command),
+    "export-store": Command("Export all frames to the local frame store", no_arguments, export_store_command),
+    "serve": Command("Serve lines from the local frame store over HTTP", serve_arguments, serve_command),
+    "worker": Command("Work through a stage, sharing episodes with other workers", worker_arguments, worker_command),
+    "load-azure": Command("Load all frames into the Azure table at AZURE_TABLE_URL", no_arguments, load_azure_command),
+}
+
+def build_parser(names: Optional[Sequence[str]] = None, description: Optional[str] = None) -> argparse.ArgumentParser:
+    """
+    Builds the argument parser for the named commands (all of them by default). With a single
+    command its arguments are added directly, rather than under a subcommand
+    """
+    names = names or list(COMMANDS)
+    parser = argparse.ArgumentParser(description=description or "Extracts frames for each subtitle line of a series")
+    parser.add_argument("--root", type=Path, default=None,
+        help="Root directory of the source, mediainfo and frames directories. "
+             "Defaults to GATARI_ROOT, or /mnt/e/gatari_lines")
+
+    if len(names) == 1:
+        command = COMMANDS[names[0]]
+        command.add_arguments(parser)
+        parser.set_defaults(handler=command.handler)
+        return parser
+
+    commands = parser.add_subparsers(dest="command", required=True, metavar="command")
+    for name in names:
+        command = COMMANDS[name]
+        command_parser = commands.add_parser(name, help=command.help)
+        command.add_arguments(command_parser)
+        command_parser.set_defaults(handler=command.handler)
+    return parser
+
+def main(argv: Optional[List[str]] = None, names: Optional[Sequence[str]] = None, description: Optional[str] = None):
+    """
+    Parses the command line and runs the chosen command. Scripts that run a subset of the
+    commands on their own pass their names, and a description for --help
+    """
+    args = build_parser(names, description).parse_args(argv)
+    args.handler(PipelinePaths.from_root(args.root), args)
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,44 @@
 """
-Looks for frame_info.json files, and then emits an HTML file in the same
-path that contains the frame that was extracted, along with some basic information
+Looks for frame_info.json files, and then emits HTML files in the same
+path that contain the frames that were extracted, along with some basic information.
+An index page linking to every episode is written to the frames directory.
+
+Pages are only regenerated when their frame_info.json has changed since the last run,
+which is tracked in a manifest stored next to the index page.
 """
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from os import path
 import glob
 import json
+import os
 from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from jinja2 import Environment, FileSystemLoader, Template, select_autoescape
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from file_state import check_file
+from models import PipelinePaths
 
-SUB_VERSION = 1
-ROOT_PATH = Path("/mnt/e/gatari_lines")
-SOURCE_PATH = ROOT_PATH / Path("source")
-EPISODES_FILE = SOURCE_PATH / "Episodes.csv"
-OUTPUT_PATH = ROOT_PATH / Path("mediainfo")
-FRAME_PATH = ROOT_PATH / Path("frames")
+MANIFEST_FILE_NAME = "preview_manifest.json"
+INDEX_FILE_NAME = "index.html"
+TEMPLATE_PATH = Path(__file__).parent / "templates"
 
-env = Environment(
-    loader=FileSystemLoader("templates"),
-    autoescape=select_autoescape()
-)
-template = env.get_template("episode_preview.jinja")
+# Bump this when the templates change, so all existing pages are regenerated
+PREVIEW_VERSION = 3
+# Maximum number of lines shown on a single preview page
+PAGE_SIZE = 200
+
+@lru_cache(maxsize=None)
+def get_template(name: str) -> Template:
+    """
+    Loads a template, caching it for the life of the (worker) process
+    """
+    env = Environment(
+        loader=FileSystemLoader(TEMPLATE_PATH),
+        autoescape=select_autoescape()
+    )
+    return env.get_template(name)
 
 def ms_to_hhmmssff(time_ms, main_sep=':', frac_sep='.'):
     """
@@ -33,14 +51,144 @@ def ms_to_hhmmssff(time_ms, main_sep=':', frac_sep='.'):
 
     return f"{hours}{main_sep}{minutes:02}{main_sep}{seconds:02}{frac_sep}{fraction:02}"
 
-for frameinfo_filename in glob.glob(path.join(FRAME_PATH, "**", "frame_info.json")):
-    frames = json.load(open(frameinfo_filename, 'r', encoding='utf8'))
-    with open(Path(frameinfo_filename).parent / 'preview.html','w', encoding='utf8') as f:
-        f.write(template.render(frames=[{
-            "path": f['frame_path'].split('/')[1],
-            "sub": f['start'],
-            "extracted": f["extracted"],
-            "target": ms_to_hhmmssff((f["start_ms"]+f["end_ms"])/2),
-            "text": f['text'].replace('\n','<br>')
-        } for f in frames]))
-    
\ No newline at end of file
+def page_file_name(page: int) -> str:
+    """
+    Returns the file name for a (zero based) preview page. The first page keeps
+    the name preview.html so existing links still work
+    """
+    return "preview.html" if page == 0 else f"preview_{page + 1}.html"
+
+def load_manifest(manifest_file: Path) -> Dict[str, Any]:
+    """
+    Loads the manifest of previously rendered episodes, or an empty one if it's missing or unreadable
+    """
+    try:
+        with open(manifest_file, "r", encoding="utf8") as in_file:
+            return json.load(in_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest_file: Path, manifest: Dict[str, Any]):
+    """
+    Writes out the manifest, replacing the old one only once it's completely written
+    """
+    temp_file = manifest_file.with_suffix(".tmp")
+    with open(temp_file, "w", encoding="utf8") as out_file:
+        json.dump(manifest, out_file, indent=2)
+    os.replace(temp_file, manifest_file)
+
+def render_episode(frameinfo_filename: str) -> Dict[str, Any]:
+    """
+    Renders the preview pages for one frame_info.json file, returning a summary
+    of the episode that is used for the index page
+    """
+    frame_dir = Path(frameinfo_filename).parent
+    with open(frameinfo_filename, "r", encoding="utf8") as frameinfo_file:
+        frames = json.load(frameinfo_file)
+
+    template = get_template("episode_preview.jinja")
+    page_count = max(1, -(-len(frames) // PAGE_SIZE))
+    pages = [{"number": p + 1, "path": page_file_name(p)} for p in range(page_count)]
+
+    for page in range(page_count):
+        page_frames = frames[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+        with open(frame_dir / page_file_name(page), "w", encoding="utf8") as out_file:
+            out_file.writelines(template.generate(
+                title=frame_dir.name,
+                page=page + 1,
+                pages=pages,
+                frames=({
+                    "path": f['frame_path'].split('/')[1],
+                    # The last scaled copy is the smallest
+                    "thumbnail": ([*f.get('scaled_paths', {}).values()] or [f['frame_path']])[-1].split('/')[1],
+                    "width": f.get('width', 0),
+                    "height": f.get('height', 0),
+                    "sub": f['start'],
+                    "extracted": f["extracted"],
+                    "target": ms_to_hhmmssff((f["start_ms"]+f["end_ms"])/2),
+                    "text": f['text'].replace('\n','<br>')
+                } for f in page_frames)))
+
+    # Remove pages left over from a previous render that had more lines
+    stale_page = page_count
+    while (frame_dir / page_file_name(stale_page)).exists():
+        (frame_dir / page_file_name(stale_page)).unlink()
+        stale_page += 1
+
+    summary = {
+        "directory": frame_dir.name,
+        "lines": len(frames),
+        "pages": page_count,
+    }
+    if frames:
+        summary.update({
+            "overall_order": frames[0]["overall_order"],
+            "series_name": frames[0]["series_name"],
+            "episode_number": frames[0]["episode_number"],
+        })
+    else:
+        summary.update({
+            "overall_order": int(frame_dir.name.split("_")[0]),
+            "series_name": frame_dir.name,
+            "episode_number": 0,
+        })
+    print(f"Rendered {frame_dir.name} ({len(frames)} lines, {page_count} pages)")
+    return summary
+
+def render_index(index_file: Path, episodes: List[Dict[str, Any]]):
+    """
+    Renders the index page linking to every episode's preview, in overall order
+    """
+    template = get_template("preview_index.jinja")
+    with open(index_file, "w", encoding="utf8") as out_file:
+        out_file.writelines(template.generate(
+            episodes=sorted(episodes, key=lambda e: (e["overall_order"], e["directory"]))))
+
+def main(paths: PipelinePaths, force: bool = False, jobs: Optional[int] = None):
+    """
+    Regenerates preview pages for any frame_info.json that has changed since the
+    last run (or all of them if force is set), rendering episodes in parallel, and then
+    rewrites the index page
+    """
+    manifest_file = paths.frames / MANIFEST_FILE_NAME
+    manifest = load_manifest(manifest_file)
+    updated_manifest: Dict[str, Any] = {}
+    to_render: List[str] = []
+
+    for frameinfo_filename in sorted(glob.glob(path.join(paths.frames, "**", "frame_info.json"))):
+        key = Path(frameinfo_filename).parent.name
+        entry = manifest.get(key)
+        if force or (entry and entry["version"] != PREVIEW_VERSION):
+            entry = None
+
+        changed, state = check_file(Path(frameinfo_filename), entry)
+        if entry and not changed:
+            updated_manifest[key] = {**entry, **state}
+            continue
+
+        updated_manifest[key] = {"version": PREVIEW_VERSION, **state}
+        to_render.append(frameinfo_filename)
+
+    print(f"{len(to_render)} of {len(updated_manifest)} episodes need rendering")
+    failed: List[str] = []
+    if to_render:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(render_episode, f): Path(f).parent.name for f in to_render}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    updated_manifest[key]["summary"] = future.result()
+                except Exception as error: # pylint: disable=broad-except
+                    # Leave it out of the manifest, so it's rendered again next time
+                    print(f"Failed to render {key}: {error!r}")
+                    del updated_manifest[key]
+                    failed.append(key)
+
+    render_index(paths.frames / INDEX_FILE_NAME, [e["summary"] for e in updated_manifest.values()])
+    save_manifest(manifest_file, updated_manifest)
+    if failed:
+        print(f"{len(failed)} episodes failed to render and were left out of the index: {', '.join(sorted(failed))}")
+
+if __name__ == "__main__":
+    import gatari
+    gatari.main(names=["preview"], description="Generates HTML previews of extracted frames")
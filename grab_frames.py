@@ -6,40 +6,143 @@ from os import path
 import glob
 import json
 from pathlib import Path
-from dataclasses import asdict
-from typing import List
+from dataclasses import asdict, dataclass
+import threading
+import time
+from typing import Annotated, Dict, Iterator, List, Optional, Tuple
 import av
 from av.filter import Graph
+from av.video.frame import VideoFrame
+from PIL import Image
+import psutil
 
-from models import EpisodeInfo, SubtitleLine, ExtractedFrame
-SUB_VERSION = 1
-ROOT_PATH = Path("/mnt/e/gatari_lines")
-SOURCE_PATH = ROOT_PATH / Path("source")
-EPISODES_FILE = SOURCE_PATH / "Episodes.csv"
-OUTPUT_PATH = ROOT_PATH / Path("mediainfo")
-FRAME_PATH = ROOT_PATH / Path("frames")
+from models import EpisodeInfo, PipelinePaths, SubtitleLine, ExtractedFrame
 
-def read_frames(episode: EpisodeInfo):
+# Scaled copies of each frame written alongside the full size one, as name -> width in pixels.
+# The smallest is the thumbnail that the preview pages display, so keep it at least as wide
+# as the images on those pages.
+RESOLUTION_LADDER: Dict[str, int] = {
+    "thumb": 640,
+}
+
+@dataclass
+class EpisodeSummary:
+    """
+    Results of extracting frames from one episode, for the run summary
     """
-    Uses ffmpeg configured to burn in subtitles to make
-    a generator for each frame in the source file
+    name: Annotated[str, "Name of the episode's frame directory"]
+    frames: Annotated[int, "Number of frames extracted"]
+    seconds: Annotated[float, "Time spent on the episode"]
+    peak_rss: Annotated[int, "Highest resident set size of the process while extracting, in bytes"]
+    skipped: Annotated[bool, "True if the episode already had frames, so nothing was done"] = False
+
+class FrameSource:
+    """
+    Uses ffmpeg configured to burn in subtitles to decode the frames of an episode.
+
+    Meant to be used as a context manager, so the decoder, filter graph and container are
+    released as soon as extraction finishes, even if it stops early or raises
     """
-    container = av.open(str(episode.file_path))
-    container.streams.video[0].thread_type = "AUTO"
-    graph = Graph()
+    def __init__(self, episode: EpisodeInfo):
+        self.episode = episode
+        self._container: Optional[av.container.InputContainer] = None
+        self._graph: Optional[Graph] = None
+        self._frames: Optional[Iterator[Tuple[float, VideoFrame]]] = None
+
+    def __enter__(self):
+        self._container = av.open(str(self.episode.file_path))
+        # __exit__ isn't called if this raises, so close the container here
+        try:
+            stream = self._container.streams.video[0]
+            stream.thread_type = "AUTO"
+
+            self._graph = Graph()
+            in_video = self._graph.add_buffer(template=stream)
+            subs = self._graph.add("subtitles", filename=str(self.episode.file_path), si="0")
+            sink = self._graph.add("buffersink")
+
+            in_video.link_to(subs)
+            subs.link_to(sink)
+            self._graph.configure()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        Stops decoding, and frees the filter graph and container
+        """
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+        self._graph = None
+        if self._container is not None:
+            self._container.close()
+            self._container = None
 
-    in_video = graph.add_buffer(template=container.streams.video[0])
-    subs = graph.add("subtitles", filename=str(episode.file_path), si="0")
-    sink = graph.add("buffersink")
+    def frames(self) -> Iterator[Tuple[float, VideoFrame]]:
+        """
+        Returns a generator of (time, frame) for each frame of the video, with subtitles burned in.
+        Only one frame is handed out at a time, so nothing should hold on to a frame
+        after asking for the next one
+        """
+        if self._frames is None:
+            self._frames = self._read()
+        return self._frames
 
-    in_video.link_to(subs)
-    subs.link_to(sink)
-    graph.configure()
+    def _read(self) -> Iterator[Tuple[float, VideoFrame]]:
+        assert self._container is not None and self._graph is not None
+        for frame in self._container.decode(self._container.streams.video[0]):
+            self._graph.push(frame)
+            del frame
+            yield from self._drain()
 
-    for frame in container.decode(container.streams.video[0]):
-        graph.push(frame)
-        pulled = graph.pull()
-        yield (pulled.time, pulled)
+        # Signal the end of the video, so the graph hands over anything it's still holding
+        self._graph.push(None)
+        yield from self._drain()
+
+    def _drain(self) -> Iterator[Tuple[float, VideoFrame]]:
+        """
+        Pulls every frame that is ready from the graph, so they never queue up in the sink
+        """
+        assert self._graph is not None
+        while True:
+            try:
+                pulled = self._graph.pull()
+            except (BlockingIOError, EOFError):
+                return
+            yield (pulled.time, pulled)
+            del pulled
+
+class PeakRssMonitor:
+    """
+    Samples the resident set size of this process in a background thread while in use,
+    keeping the highest value seen
+    """
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.peak = self._process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._process.memory_info().rss)
 
 def ms_to_hhmmssff(time_ms, main_sep=':', frac_sep='.'):
     """
@@ -52,59 +155,91 @@ def ms_to_hhmmssff(time_ms, main_sep=':', frac_sep='.'):
 
     return f"{hours}{main_sep}{minutes:02}{main_sep}{seconds:02}{frac_sep}{fraction:02}"
 
-def extract_subtitles(episode: EpisodeInfo, subtitles: List[SubtitleLine]):
+def save_frame(image: Image.Image, frame_dir: Path, frame_name: str) -> Dict[str, str]:
+    """
+    Saves a decoded frame at full size, along with a scaled copy for each entry in
+    RESOLUTION_LADDER. Each copy is scaled from the next largest one, so the frame
+    is only converted from the decoder once. Returns the scaled file names keyed by ladder name,
+    largest first
+    """
+    image.save(frame_dir / frame_name)
+
+    stem = Path(frame_name).stem
+    scaled_names: Dict[str, str] = {}
+    scaled = image
+    for name, width in sorted(RESOLUTION_LADDER.items(), key=lambda r: r[1], reverse=True):
+        if width >= scaled.width:
+            continue
+        height = round(scaled.height * width / scaled.width)
+        scaled = scaled.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        scaled_name = f"{stem}.{name}.jpg"
+        scaled.save(frame_dir / scaled_name)
+        scaled_names[name] = scaled_name
+    return scaled_names
+
+def extract_subtitles(episode: EpisodeInfo, subtitles: List[SubtitleLine], frame_path: Path,
+                      stop: Optional[threading.Event] = None) -> Optional[int]:
     """
     Enumerates through the provided list of subtitles, while at the same time
-    enumerating through the video frames provided by read_frames. When a subtitle
-    is on the screen, save out the frame.
+    enumerating through the video frames provided by a FrameSource. When a subtitle
+    is on the screen, save out the frame. Returns the number of frames saved, or None
+    if the episode already had frames. Raises InterruptedError, without writing
+    frame_info.json, if stop is set part way through
     """
-    base_frame_name = f"{episode_info.overall_order:03}_{episode_info.series_order:02}_{episode_info.series_name}_{episode_info.episode_number:02}"
-    frame_dir = FRAME_PATH / base_frame_name
+    base_frame_name = f"{episode.overall_order:03}_{episode.series_order:02}_{episode.series_name}_{episode.episode_number:02}"
+    frame_dir = frame_path / base_frame_name
     frame_dir.mkdir(parents=True, exist_ok=True)
 
     frame_info_path = frame_dir / "frame_info.json"
 
     if frame_info_path.exists():
         print(f"Skipping {episode.file_path}")
-        return
+        return None
 
     sub_times = sorted((((((sub.start_ms + sub.end_ms) / 2) / 1000), sub) for sub in subtitles), key=lambda t: t[0])
 
-    frames = read_frames(episode)
     extracted: list[ExtractedFrame] = []
-    for sub_time, sub in sub_times:
-        for frame_time, frame in frames:
-            if frame_time >= sub_time:
-                frame_name = f"{base_frame_name}_{ms_to_hhmmssff(sub_time * 1000,'_','_')}.jpg"
-                frame_path = frame_dir / frame_name
-                frame.to_image().save(frame_path)
-                print(f"{episode.series_name} {episode.episode_number:02} - {ms_to_hhmmssff(sub.start_ms)} -> {frame_name}:\n {sub.text} ")
-                extracted.append(ExtractedFrame(
-                    episode.series_order,
-                    episode.series_name,
-                    episode.episode_number,
-                    episode.overall_order,
-                    sub.start,
-                    sub.start_ms,
-                    sub.end,
-                    sub.end_ms,
-                    ms_to_hhmmssff(frame_time * 1000),
-                    frame_time* 1000,
-                    sub.text,
-                    f"{base_frame_name}/{frame_name}"
-                ))
-                break
+    with FrameSource(episode) as source:
+        frames = source.frames()
+        for sub_time, sub in sub_times:
+            if stop is not None and stop.is_set():
+                raise InterruptedError(f"Stopped extracting frames from {episode.file_path}")
+            for frame_time, frame in frames:
+                if frame_time >= sub_time:
+                    frame_name = f"{base_frame_name}_{ms_to_hhmmssff(sub_time * 1000,'_','_')}.jpg"
+                    image = frame.to_image()
+                    scaled_names = save_frame(image, frame_dir, frame_name)
+                    print(f"{episode.series_name} {episode.episode_number:02} - "
+                          f"{ms_to_hhmmssff(sub.start_ms)} -> {frame_name}:\n {sub.text} ")
+                    extracted.append(ExtractedFrame(
+                        episode.series_order,
+                        episode.series_name,
+                        episode.episode_number,
+                        episode.overall_order,
+                        sub.start,
+                        sub.start_ms,
+                        sub.end,
+                        sub.end_ms,
+                        ms_to_hhmmssff(frame_time * 1000),
+                        frame_time* 1000,
+                        sub.text,
+                        f"{base_frame_name}/{frame_name}",
+                        image.width,
+                        image.height,
+                        {n: f"{base_frame_name}/{f}" for n, f in scaled_names.items()}
+                    ))
+                    del frame
+                    break
     print(f"{episode.series_name} {episode.episode_number:02} - Completed")
     with open(frame_info_path, "w", encoding="utf8") as frame_info_file:
         json.dump([asdict(e) for e in extracted], frame_info_file, indent=2)
+    return len(extracted)
 
-for episode_info_filename in glob.glob(path.join(OUTPUT_PATH, "**", "episode_info.json")):
-    base_path = Path(episode_info_filename).parent
-
-    with open(episode_info_filename, "r", encoding="utf8") as episode_info_file:
-        episode_info = EpisodeInfo.from_json_dict(json.load(episode_info_file))
-
-    with open(base_path / 'subs.json', "r", encoding="utf8") as subs_file:
+def load_subtitles(episode_dir: Path) -> List[SubtitleLine]:
+    """
+    Loads the processed subtitles for an episode, from the default track if there is more than one
+    """
+    with open(episode_dir / 'subs.json', "r", encoding="utf8") as subs_file:
         sub_info = json.load(subs_file)
 
     if len(sub_info) == 1:
@@ -113,12 +248,53 @@ for episode_info_filename in glob.glob(path.join(OUTPUT_PATH, "**", "episode_inf
         sub_track_info = next(
             (t for t in sub_info if t['info']['properties']['default_track']),
             sub_info[0])
-    print(base_path)
     sub_path = Path(sub_track_info['file_name']).parent / f"{sub_track_info['track']}_{sub_track_info['language']}.json"
 
     with open(sub_path, "r", encoding="utf8") as sub_file:
         json_subs = json.load(sub_file)
-        sub_lines = [SubtitleLine.from_json_dict(l) for l in json_subs['subs']]
+    return [SubtitleLine.from_json_dict(l) for l in json_subs['subs']]
+
+def process_episode(episode_dir: Path, paths: PipelinePaths, stop: Optional[threading.Event] = None) -> EpisodeSummary:
+    """
+    Extracts the frames for one episode directory in mediainfo, stopping early if stop is set
+    """
+    with open(episode_dir / "episode_info.json", "r", encoding="utf8") as episode_info_file:
+        episode_info = EpisodeInfo.from_json_dict(json.load(episode_info_file))
+
+    print(episode_dir)
+    start = time.perf_counter()
+    with PeakRssMonitor() as monitor:
+        frame_count = extract_subtitles(episode_info, load_subtitles(episode_dir), paths.frames, stop)
+
+    summary = EpisodeSummary(
+        episode_dir.name,
+        frame_count or 0,
+        time.perf_counter() - start,
+        monitor.peak,
+        frame_count is None)
+    print(f"{summary.name} - {summary.frames} frames in {summary.seconds:.1f}s, peak RSS {summary.peak_rss / 2**20:.0f} MiB")
+    return summary
+
+def print_summary(summaries: List[EpisodeSummary]):
+    """
+    Prints the frames, time and peak memory of each episode processed in a run
+    """
+    print(f"{'Episode':<60} {'Frames':>7} {'Seconds':>9} {'Peak RSS MiB':>13}")
+    for summary in summaries:
+        if summary.skipped:
+            print(f"{summary.name:<60} {'skipped':>7}")
+            continue
+        print(f"{summary.name:<60} {summary.frames:>7} {summary.seconds:>9.1f} {summary.peak_rss / 2**20:>13.0f}")
+
+def main(paths: PipelinePaths):
+    """
+    Extracts frames for every episode with processed subtitles
+    """
+    summaries = [
+        process_episode(Path(episode_info_filename).parent, paths)
+        for episode_info_filename in glob.glob(path.join(paths.mediainfo, "**", "episode_info.json"))
+    ]
+    print_summary(summaries)
 
-    extract_subtitles(episode_info, sub_lines)
-    
\ No newline at end of file
+if __name__ == "__main__":
+    main(PipelinePaths.from_root())
@@ -0,0 +1,359 @@
+"""
+Builds and queries an inverted index over the text of every extracted frame, so a line
+can be found without grepping every frame_info.json.
+
+Each episode is tokenized into a segment file that is only rebuilt when its frame_info.json
+changes. The segments are then merged into a single binary index file that is memory mapped
+for queries. Latin text is split into lowercased words, CJK text into single characters
+and character bigrams.
+"""
+from dataclasses import asdict, dataclass
+from itertools import groupby
+from os import path
+import glob
+import json
+import mmap
+import os
+from pathlib import Path
+import re
+import struct
+from typing import Annotated, Any, Dict, Iterator, List, Optional
+
+from file_state import check_file
+from models import PipelinePaths
+from process_subs import is_cjk
+
+INDEX_FILE_NAME = "lines.idx"
+SEGMENT_DIR_NAME = "segments"
+
+# Bump this when tokenization or the file format changes, so everything is rebuilt
+INDEX_VERSION = 1
+INDEX_MAGIC = b"GLIX"
+# magic, version, document count, term count
+HEADER = struct.Struct("<4sIII")
+OFFSET = struct.Struct("<I")
+
+WORD = re.compile(r"\w+")
+
+@dataclass(frozen=True)
+class IndexedLine:
+    """
+    A line returned from a query against the index
+    """
+    episode: Annotated[str, "Name of the frame directory for the episode"]
+    series_name: Annotated[str, "The name of the series for this episode"]
+    episode_number: Annotated[int, "The number of the episode within the work"]
+    overall_order: Annotated[int, "The number of the episode within the overall work"]
+    extracted_ms: Annotated[int, "Time in milliseconds of when this frame was extracted"]
+    start_ms: Annotated[int, "Time in milliseconds of when this subtitle is displayed"]
+    text: Annotated[str, "Text only version of subtitle"]
+    frame_path: Annotated[str, "The relative path of the frame to the subtitle output directory"]
+
+def split_runs(text: str) -> Iterator[tuple[bool, str]]:
+    """
+    Splits lowercased text into runs of CJK and non-CJK characters
+    """
+    for run_is_cjk, chars in groupby(text.lower(), key=is_cjk):
+        yield run_is_cjk, "".join(chars)
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into index terms. Latin text becomes whole words, CJK text becomes
+    character bigrams, along with single characters so one character queries work
+    """
+    tokens: List[str] = []
+    for run_is_cjk, run in split_runs(text):
+        if run_is_cjk:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.extend(WORD.findall(run))
+    return tokens
+
+def query_terms(text: str) -> List[str]:
+    """
+    Splits a query into the smallest set of terms that have to be present in a matching line
+    """
+    terms: List[str] = []
+    for run_is_cjk, run in split_runs(text):
+        if run_is_cjk:
+            terms.extend([run] if len(run) == 1 else (run[i:i + 2] for i in range(len(run) - 1)))
+        else:
+            terms.extend(WORD.findall(run))
+    return list(dict.fromkeys(terms))
+
+def normalize(text: str) -> str:
+    """
+    Reduces text to the form used to check that query terms appear together, in order.
+    Every word and CJK character is surrounded by spaces, so a substring test on two
+    normalized strings only matches whole words
+    """
+    units: List[str] = []
+    for run_is_cjk, run in split_runs(text):
+        units.extend(run if run_is_cjk else WORD.findall(run))
+    return f" {' '.join(units)} "
+
+def encode_postings(doc_ids: List[int]) -> bytes:
+    """
+    Encodes a sorted list of document ids as varint deltas
+    """
+    out = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        delta = doc_id - previous
+        previous = doc_id
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+def decode_postings(data: bytes) -> List[int]:
+    """
+    Decodes varint delta encoded document ids
+    """
+    doc_ids: List[int] = []
+    current = shift = value = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            current += value
+            doc_ids.append(current)
+            shift = value = 0
+    return doc_ids
+
+def build_segment(frameinfo_filename: Path) -> Dict[str, Any]:
+    """
+    Tokenizes the lines of one episode, returning its documents and postings
+    """
+    episode = frameinfo_filename.parent.name
+    with open(frameinfo_filename, "r", encoding="utf8") as frameinfo_file:
+        frames = sorted(json.load(frameinfo_file), key=lambda f: f["extracted_ms"])
+
+    docs = [{
+        "episode": episode,
+        "series_name": f["series_name"],
+        "episode_number": f["episode_number"],
+        "overall_order": f["overall_order"],
+        "extracted_ms": round(f["extracted_ms"]),
+        "start_ms": f["start_ms"],
+        "text": f["text"],
+        "frame_path": f["frame_path"],
+    } for f in frames]
+
+    postings: Dict[str, List[int]] = {}
+    for doc_id, doc in enumerate(docs):
+        for term in dict.fromkeys(tokenize(doc["text"])):
+            postings.setdefault(term, []).append(doc_id)
+
+    return {"docs": docs, "postings": postings}
+
+def update_segments(paths: PipelinePaths, force: bool = False) -> bool:
+    """
+    Rebuilds the segment for every episode whose frame_info.json has changed, and removes
+    segments for episodes that no longer exist. Returns True if any segment changed
+    """
+    segment_path = paths.index / SEGMENT_DIR_NAME
+    segment_path.mkdir(parents=True, exist_ok=True)
+    changed = False
+    seen = set()
+
+    for frameinfo_filename in sorted(glob.glob(path.join(paths.frames, "**", "frame_info.json"))):
+        frameinfo_path = Path(frameinfo_filename)
+        segment_file = segment_path / f"{frameinfo_path.parent.name}.json"
+        seen.add(segment_file.name)
+
+        existing: Optional[Dict[str, Any]] = None
+        if not force and segment_file.exists():
+            with open(segment_file, "r", encoding="utf8") as in_file:
+                existing = json.load(in_file)
+        if existing and existing["version"] != INDEX_VERSION:
+            existing = None
+
+        contents_changed, state = check_file(frameinfo_path, existing)
+        if existing and not contents_changed:
+            if all(existing[k] == v for k, v in state.items()):
+                continue
+            segment = existing
+        else:
+            segment = build_segment(frameinfo_path)
+            changed = True
+            print(f"Indexed {frameinfo_path.parent.name}")
+
+        segment.update(version=INDEX_VERSION, **state)
+        with open(segment_file, "w", encoding="utf8") as out_file:
+            json.dump(segment, out_file, ensure_ascii=False)
+
+    for segment_file in segment_path.glob("*.json"):
+        if segment_file.name not in seen:
+            segment_file.unlink()
+            changed = True
+
+    return changed
+
+def merge_segments(paths: PipelinePaths):
+    """
+    Merges all segments into the index file. Documents are numbered in overall order
+    and then by extraction time, so postings come back already in that order
+    """
+    segments = []
+    for segment_file in (paths.index / SEGMENT_DIR_NAME).glob("*.json"):
+        with open(segment_file, "r", encoding="utf8") as in_file:
+            segments.append(json.load(in_file))
+    segments = [s for s in segments if s["docs"]]
+    segments.sort(key=lambda s: (s["docs"][0]["overall_order"], s["docs"][0]["episode"]))
+
+    docs: List[bytes] = []
+    postings: Dict[str, List[int]] = {}
+    for segment in segments:
+        base = len(docs)
+        docs.extend(json.dumps(d, ensure_ascii=False).encode("utf8") for d in segment["docs"])
+        for term, doc_ids in segment["postings"].items():
+            postings.setdefault(term, []).extend(base + d for d in doc_ids)
+
+    terms = sorted((t.encode("utf8") for t in postings))
+    encoded = [encode_postings(postings[t.decode("utf8")]) for t in terms]
+
+    def offsets(blobs: List[bytes]) -> bytes:
+        out = bytearray(OFFSET.pack(0))
+        position = 0
+        for blob in blobs:
+            position += len(blob)
+            out += OFFSET.pack(position)
+        return bytes(out)
+
+    index_file = paths.index / INDEX_FILE_NAME
+    temp_file = index_file.with_suffix(".tmp")
+    with open(temp_file, "wb") as out_file:
+        out_file.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(docs), len(terms)))
+        out_file.write(offsets(docs))
+        out_file.write(offsets(terms))
+        out_file.write(offsets(encoded))
+        for blobs in (docs, terms, encoded):
+            out_file.writelines(blobs)
+    os.replace(temp_file, index_file)
+    print(f"Wrote {index_file} ({len(docs)} lines, {len(terms)} terms)")
+
+def build_index(paths: PipelinePaths, force: bool = False):
+    """
+    Brings the segments up to date, and merges them if anything changed
+    """
+    if update_segments(paths, force) or force or not (paths.index / INDEX_FILE_NAME).exists():
+        merge_segments(paths)
+    else:
+        print("Index is up to date")
+
+class LineIndex:
+    """
+    Read-only view of a merged index file
+    """
+    def __init__(self, index_file: Path):
+        with open(index_file, "rb") as in_file:
+            self._data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.doc_count, self.term_count = HEADER.unpack_from(self._data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise ValueError(f"{index_file} is not a version {INDEX_VERSION} line index, rebuild it")
+
+        self._doc_offsets = HEADER.size
+        self._term_offsets = self._doc_offsets + (self.doc_count + 1) * OFFSET.size
+        self._postings_offsets = self._term_offsets + (self.term_count + 1) * OFFSET.size
+        self._docs = self._postings_offsets + (self.term_count + 1) * OFFSET.size
+        self._terms = self._docs + self._offset(self._doc_offsets, self.doc_count)
+        self._postings = self._terms + self._offset(self._term_offsets, self.term_count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps the index file
+        """
+        self._data.close()
+
+    def _offset(self, table: int, i: int) -> int:
+        return OFFSET.unpack_from(self._data, table + i * OFFSET.size)[0]
+
+    def _blob(self, table: int, base: int, i: int) -> bytes:
+        return self._data[base + self._offset(table, i):base + self._offset(table, i + 1)]
+
+    def postings(self, term: str) -> List[int]:
+        """
+        Returns the ids of documents containing a term, found by binary search of the term table
+        """
+        key = term.encode("utf8")
+        low, high = 0, self.term_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._blob(self._term_offsets, self._terms, mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == self.term_count or self._blob(self._term_offsets, self._terms, low) != key:
+            return []
+        return decode_postings(self._blob(self._postings_offsets, self._postings, low))
+
+    def document(self, doc_id: int) -> IndexedLine:
+        """
+        Loads a stored document
+        """
+        return IndexedLine(**json.loads(self._blob(self._doc_offsets, self._docs, doc_id)))
+
+    def search(self, text: str, limit: Optional[int] = None) -> List[IndexedLine]:
+        """
+        Returns lines containing all of the words (or characters) of the query in order,
+        sorted by overall order and extraction time
+        """
+        terms = query_terms(text)
+        if not terms:
+            return []
+
+        candidates: Optional[set[int]] = None
+        for doc_ids in sorted((self.postings(t) for t in terms), key=len):
+            candidates = set(doc_ids) if candidates is None else candidates.intersection(doc_ids)
+            if not candidates:
+                return []
+
+        phrase = normalize(text)
+        matches: List[IndexedLine] = []
+        for doc_id in sorted(candidates or []):
+            line = self.document(doc_id)
+            if phrase in normalize(line.text):
+                matches.append(line)
+                if limit and len(matches) >= limit:
+                    break
+        return matches
+
+def query(paths: PipelinePaths, text: str, limit: Optional[int] = None, as_json: bool = False):
+    """
+    Prints the lines matching a query
+    """
+    index_file = paths.index / INDEX_FILE_NAME
+    if not index_file.exists():
+        print(f'{index_file} does not exist, run `index` (or `line_index.py index`) first')
+        return
+
+    with LineIndex(index_file) as index:
+        matches = index.search(text, limit)
+    if as_json:
+        print(json.dumps([asdict(m) for m in matches], ensure_ascii=False, indent=2))
+        return
+    for match in matches:
+        print(f"{match.episode} {match.extracted_ms} {match.frame_path}")
+        print(f"  {match.text}")
+
+def main():
+    """
+    Builds or queries the line index from the command line
+    """
+    import gatari # pylint: disable=import-outside-toplevel
+    gatari.main(names=["index", "query"], description="Builds and queries an index of all extracted lines")
+
+if __name__ == "__main__":
+    main()
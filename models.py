@@ -1,9 +1,76 @@
 """
 Common dataclasses shared between multiple scripts
 """
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import os
 from pathlib import Path
-from typing import Annotated, Dict, Tuple
+from typing import Annotated, Dict, Optional, Tuple
+
+DEFAULT_ROOT_PATH = Path("/mnt/e/gatari_lines")
+
+@dataclass(frozen=True)
+class PipelinePaths:
+    """
+    Locations of everything the scripts read and write, relative to one root directory
+    """
+    root: Annotated[Path, "Directory containing the source, mediainfo and frames directories"]
+
+    @property
+    def source(self) -> Path:
+        """
+        Directory containing the source video files and Episodes.csv
+        """
+        return self.root / "source"
+
+    @property
+    def episodes_file(self) -> Path:
+        """
+        CSV listing every episode to process
+        """
+        return self.source / "Episodes.csv"
+
+    @property
+    def mediainfo(self) -> Path:
+        """
+        Directory for the artifacts extracted from each episode
+        """
+        return self.root / "mediainfo"
+
+    @property
+    def frames(self) -> Path:
+        """
+        Directory for the extracted frames, one directory per episode
+        """
+        return self.root / "frames"
+
+    @property
+    def index(self) -> Path:
+        """
+        Directory for the line index and its segments
+        """
+        return self.root / "index"
+
+    @property
+    def queue(self) -> Path:
+        """
+        Directory for the lease files used to share work between machines
+        """
+        return self.root / "queue"
+
+    @property
+    def store_file(self) -> Path:
+        """
+        File the frames are exported to for the local lookup service
+        """
+        return self.root / "frames.dat"
+
+    @classmethod
+    def from_root(cls, root: Optional[Path] = None):
+        """
+        Creates an instance from the given root, falling back to the GATARI_ROOT
+        environment variable and then the default root
+        """
+        return PipelinePaths(Path(root or os.environ.get("GATARI_ROOT") or DEFAULT_ROOT_PATH))
 
 @dataclass
 class EpisodeInfo:
@@ -90,6 +157,24 @@ class ExtractedFrame:
     extracted_ms: Annotated[int, "Time in milliseconds of when this frame was extracted"]
     text: Annotated[str, "Text only version of subtitle"]
     frame_path: Annotated[str, "The relative path of the frame to the subtitle output directory"]
+    width: Annotated[int, "Width in pixels of the full size frame, or 0 if it wasn't recorded"] = 0
+    height: Annotated[int, "Height in pixels of the full size frame, or 0 if it wasn't recorded"] = 0
+    scaled_paths: Annotated[Dict[str, str], "Relative paths of scaled copies of the frame, keyed by ladder name, largest first"] = \
+        field(default_factory=dict)
+
+    @property
+    def partition_key(self) -> str:
+        """
+        Key shared by every frame of this episode in the bot's table
+        """
+        return f"{self.overall_order:03}_{self.series_order:02}_{self.series_name}_{self.episode_number:02}"
+
+    @property
+    def row_key(self) -> str:
+        """
+        Key of this frame within its episode in the bot's table
+        """
+        return self.start.replace(':','_').replace('.','_')
 
     @classmethod
     def from_json_dict(cls, json_dict: Dict):
@@ -109,4 +194,7 @@ class ExtractedFrame:
             json_dict["extracted_ms"],
             json_dict["text"],
             json_dict["frame_path"],
+            json_dict.get("width", 0),
+            json_dict.get("height", 0),
+            json_dict.get("scaled_paths", {}),
         )
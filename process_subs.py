@@ -10,12 +10,8 @@ import re
 from itertools import groupby
 from dataclasses import asdict
 from typing import Any, List, Optional, Set
-from models import SubtitleLine
+from models import PipelinePaths, SubtitleLine
 SUB_VERSION = 1
-ROOT_PATH = Path("/mnt/e/gatari_lines")
-SOURCE_PATH = ROOT_PATH / Path("source")
-EPISODES_FILE = SOURCE_PATH / "Episodes.csv"
-OUTPUT_PATH = ROOT_PATH / Path("mediainfo")
 FONT_TYPES = ["application/x-truetype-font", "application/vnd.ms-opentype"]
 
 SUB_MAP = {
@@ -309,19 +305,25 @@ def process_episode(episode_dir: Path):
     for track in subs_info:
         process_sub(episode_dir, track, False)
 
-def get_episode_dirs():
+def get_episode_dirs(paths: PipelinePaths):
     """
     Finds episode directories (those containing episode_info.json files)
     """
     dirs = []
-    for episode_info_filename in glob.glob(path.join(OUTPUT_PATH, "**", "episode_info.json")):
+    for episode_info_filename in glob.glob(path.join(paths.mediainfo, "**", "episode_info.json")):
         dirs.append(Path(episode_info_filename).parent)
 
     return dirs
 
+def main(paths: PipelinePaths):
+    """
+    Processes the subtitles of every episode that attachments have been extracted from
+    """
+    for episode_dir in get_episode_dirs(paths):
+        process_episode(episode_dir)
+
 if __name__ == "__main__":
-    for episodes in get_episode_dirs():
-        process_episode(episodes)
+    main(PipelinePaths.from_root())
 
 # extracted = combine_lines(extract_ass_subtext(Path('test3.sorted.ass'))[:20])
 # print(extracted)
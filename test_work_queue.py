@@ -0,0 +1,112 @@
+"""
+Checks that workers sharing a queue directory never process the same item at the same time,
+including when one of them crashes while holding a lease, or can't renew its lease.
+
+Run with python -m unittest test_work_queue
+"""
+import errno
+from multiprocessing import Process
+import os
+from pathlib import Path
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import work_queue
+
+ITEMS = [f"{i:02}" for i in range(20)]
+LEASE_DURATION = 1
+HEARTBEAT_INTERVAL = 0.1
+WORKER_COUNT = 4
+
+def process_item(root: Path, item: str):
+    """
+    Pretends to process an item, recording a conflict if another worker is already processing it.
+    The first worker to process item 05 crashes afterwards, without releasing its lease
+    """
+    holding_file = root / "holding" / item
+    try:
+        os.close(os.open(holding_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        (root / "conflicts" / f"{item}.{os.getpid()}").touch()
+        return
+    (root / "processed" / f"{item}.{os.getpid()}").touch()
+    time.sleep(0.05)
+    holding_file.unlink()
+
+    if item == "05":
+        try:
+            os.close(os.open(root / "crashed", os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return
+        os._exit(1) # pylint: disable=protected-access
+
+def run_worker(root: Path):
+    """
+    Works through ITEMS with short leases, so a crashed worker's lease is stolen quickly
+    """
+    work_queue.POLL_INTERVAL = HEARTBEAT_INTERVAL
+    queue = work_queue.WorkQueue(root / "queue", lease_duration=LEASE_DURATION, heartbeat_interval=HEARTBEAT_INTERVAL)
+    queue.run(lambda: {i: i for i in ITEMS}, lambda item, _: process_item(root, item))
+
+class WorkQueueTest(unittest.TestCase):
+    """
+    Runs workers against a queue in a temporary directory
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.root = Path(self.temp_dir.name)
+        for name in ("holding", "processed", "conflicts"):
+            (self.root / name).mkdir()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_workers_never_share_an_item(self):
+        """
+        Several worker processes, one of which crashes, finish every item without two of them
+        processing the same item at once
+        """
+        workers = [Process(target=run_worker, args=(self.root,)) for _ in range(WORKER_COUNT)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=60)
+            self.assertFalse(worker.is_alive())
+
+        self.assertEqual(sorted(os.listdir(self.root / "conflicts")), [])
+        self.assertEqual(sorted(p.stem for p in (self.root / "queue").glob("*.done")), ITEMS)
+        processed = sorted(p.stem for p in (self.root / "processed").iterdir())
+        # The crashed worker's item is processed again by the worker that steals its lease
+        self.assertEqual(processed, sorted(ITEMS + ["05"]))
+
+    def test_unrenewable_lease_is_lost(self):
+        """
+        A lease that can't be renewed is marked as lost before another worker can steal it,
+        and a lease that only briefly can't be renewed is kept
+        """
+        holder = work_queue.WorkQueue(self.root / "queue", "holder", LEASE_DURATION, HEARTBEAT_INTERVAL)
+        thief = work_queue.WorkQueue(self.root / "queue", "thief", LEASE_DURATION, HEARTBEAT_INTERVAL)
+
+        lease = holder.try_acquire("00")
+        with mock.patch("work_queue.os.replace", side_effect=OSError(errno.EIO, "Input/output error")):
+            time.sleep(HEARTBEAT_INTERVAL * 3)
+        time.sleep(HEARTBEAT_INTERVAL * 3)
+        self.assertFalse(lease.lost.is_set())
+        self.assertIsNone(thief.try_acquire("00"))
+
+        with mock.patch("work_queue.os.replace", side_effect=OSError(errno.EIO, "Input/output error")):
+            stolen = None
+            deadline = time.monotonic() + LEASE_DURATION * 3
+            while stolen is None and time.monotonic() < deadline:
+                lost_before_steal = lease.lost.is_set()
+                stolen = thief.try_acquire("00")
+                time.sleep(HEARTBEAT_INTERVAL / 2)
+            self.assertIsNotNone(stolen)
+            self.assertTrue(lost_before_steal)
+            stolen.release()
+        lease.release()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,337 @@
+"""
+Shares the episodes of a pipeline stage between workers on any number of machines that can
+see the same root directory, using lease files in the queue directory.
+
+A worker claims an episode by creating its lease file exclusively, and keeps the lease alive
+with a heartbeat while it works. When it finishes it leaves a .done marker (or .failed, with
+the error, if processing raised) and removes the lease. A lease whose heartbeat has stopped
+for longer than LEASE_DURATION is stolen by the next worker that finds it, so episodes held by
+a crashed worker or machine are picked up again.
+
+Expiry is checked against the clock of the worker looking at the lease, so clocks on the
+machines sharing the root need to agree to well within LEASE_DURATION.
+"""
+# pylint: disable=import-outside-toplevel
+from dataclasses import dataclass
+import json
+from multiprocessing import Process
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional
+import uuid
+
+from models import PipelinePaths
+
+# Seconds a lease stays valid after its last heartbeat
+LEASE_DURATION = 300
+# Seconds between heartbeats
+HEARTBEAT_INTERVAL = 30
+# Seconds to wait before looking again when every remaining episode is leased by someone else
+POLL_INTERVAL = 15
+
+def default_owner() -> str:
+    """
+    Returns an identifier for this worker that is unique across machines
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def read_lease(lease_file: Path) -> Optional[Dict[str, Any]]:
+    """
+    Reads a lease file, returning None if it is missing or only partially written
+    """
+    try:
+        with open(lease_file, "r", encoding="utf8") as in_file:
+            return json.load(in_file)
+    except (OSError, ValueError):
+        return None
+
+class Lease:
+    """
+    A claim on one item held by this worker, kept alive by a heartbeat thread until released
+    """
+    def __init__(self, lease_file: Path, owner: str, duration: float, interval: float):
+        self.lease_file = lease_file
+        self.owner = owner
+        self.duration = duration
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, args=(interval,), daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self, interval: float):
+        # Renewing can fail for a while on a flaky shared mount, so keep retrying until the lease
+        # would have expired by the next attempt, at which point another worker may steal it
+        last_renewed = time.monotonic()
+        try:
+            while not self._stop.wait(interval):
+                attempted = time.monotonic()
+                try:
+                    if not self.renew():
+                        print(f"Lost lease {self.lease_file.name}, another worker may be processing it")
+                        return
+                    last_renewed = attempted
+                except OSError as error:
+                    print(f"Couldn't renew lease {self.lease_file.name}: {error}")
+                    if time.monotonic() + interval - last_renewed >= self.duration:
+                        print(f"Lease {self.lease_file.name} has expired, another worker may be processing it")
+                        return
+        finally:
+            # However the heartbeat ends, the lease is no longer being kept alive
+            if not self._stop.is_set():
+                self.lost.set()
+
+    def renew(self) -> bool:
+        """
+        Pushes back the expiry of the lease, as long as this worker still holds it. A lease that
+        has already expired isn't renewed, since another worker may be stealing it, and replacing
+        the file could overwrite the lease it takes
+        """
+        lease = read_lease(self.lease_file)
+        if not lease or lease["owner"] != self.owner or lease["expires"] <= time.time():
+            return False
+        temp_file = self.lease_file.with_name(f"{self.lease_file.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_file, "w", encoding="utf8") as out_file:
+                json.dump({**lease, "expires": time.time() + self.duration}, out_file)
+            os.replace(temp_file, self.lease_file)
+        finally:
+            temp_file.unlink(missing_ok=True)
+        return True
+
+    def release(self):
+        """
+        Stops the heartbeat, and removes the lease file if this worker still holds it
+        """
+        self._stop.set()
+        self._heartbeat.join()
+        lease = read_lease(self.lease_file)
+        if lease and lease["owner"] == self.owner:
+            self.lease_file.unlink(missing_ok=True)
+
+class WorkQueue:
+    """
+    Lease files for the items of one stage, kept in a directory on the shared root
+    """
+    def __init__(self, queue_dir: Path, owner: Optional[str] = None,
+                 lease_duration: float = LEASE_DURATION, heartbeat_interval: float = HEARTBEAT_INTERVAL):
+        self.queue_dir = queue_dir
+        self.owner = owner or default_owner()
+        self.lease_duration = lease_duration
+        self.heartbeat_interval = heartbeat_interval
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, item: str, suffix: str) -> Path:
+        return self.queue_dir / f"{item}.{suffix}"
+
+    def is_finished(self, item: str) -> bool:
+        """
+        Returns True if an item has been completed, or has failed
+        """
+        return self._path(item, "done").exists() or self._path(item, "failed").exists()
+
+    def try_acquire(self, item: str) -> Optional[Lease]:
+        """
+        Tries to take the lease for an item, stealing it if its holder's heartbeat has
+        stopped. Returns None if the item is finished or another worker holds it
+        """
+        if self.is_finished(item):
+            return None
+
+        lease_file = self._path(item, "lease")
+        for _ in range(2):
+            try:
+                fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._steal(lease_file):
+                    return None
+                continue
+            with os.fdopen(fd, "w", encoding="utf8") as out_file:
+                json.dump({
+                    "owner": self.owner,
+                    "acquired": time.time(),
+                    "expires": time.time() + self.lease_duration,
+                }, out_file)
+            # Another worker may have finished the item between checking and taking the lease
+            if self.is_finished(item):
+                lease_file.unlink(missing_ok=True)
+                return None
+            return Lease(lease_file, self.owner, self.lease_duration, self.heartbeat_interval)
+        return None
+
+    def _steal(self, lease_file: Path) -> bool:
+        """
+        Removes an expired lease, returning True if the lease file is now free to be created.
+        The lease is moved aside first, so only one worker can take it, and put back if a
+        fresh lease was taken in the meantime
+        """
+        lease = read_lease(lease_file)
+        if lease is None:
+            # Still being written, or just removed. Only treat it as stale once it's old
+            try:
+                if time.time() - lease_file.stat().st_mtime < self.lease_duration:
+                    return False
+            except FileNotFoundError:
+                return True
+        elif lease["expires"] > time.time():
+            return False
+
+        stale_file = lease_file.with_name(f"{lease_file.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lease_file, stale_file)
+        except FileNotFoundError:
+            return True
+
+        if read_lease(stale_file) != lease:
+            # Moved a lease that another worker had just taken, so give it back
+            try:
+                os.link(stale_file, lease_file)
+            except OSError as error:
+                # Leave it where it is rather than delete a lease that may still be live. Its
+                # holder will find it no longer holds the lease at its next heartbeat, and discard its work
+                print(f"Couldn't put back lease {lease_file.name}, left it at {stale_file.name}: {error}")
+                return False
+            stale_file.unlink(missing_ok=True)
+            return False
+
+        print(f"Stealing expired lease {lease_file.name} from {lease['owner'] if lease else 'unknown'}")
+        stale_file.unlink(missing_ok=True)
+        return True
+
+    def complete(self, item: str, lease: Lease):
+        """
+        Marks an item as done and releases its lease
+        """
+        self._path(item, "done").touch()
+        lease.release()
+
+    def fail(self, item: str, lease: Lease, error: str):
+        """
+        Marks an item as failed, recording the error, and releases its lease
+        """
+        self._path(item, "failed").write_text(f"{self.owner}\n{error}", encoding="utf8")
+        lease.release()
+
+    def discard(self, item: str, lease: Lease):
+        """
+        Releases a lease that another worker took over while this one was processing the item,
+        without marking the item, since the other worker's result is the one that counts
+        """
+        print(f"{self.owner}: lost the lease on {item} while processing it, discarding the result")
+        lease.release()
+
+    def run(self, list_items: Callable[[], Dict[str, Any]], process: Callable[[Any, threading.Event], None]):
+        """
+        Processes items until every one is finished. list_items returns the items keyed by a
+        file name safe id, and is called again on each pass so items that appear while the
+        worker is running are picked up. process is passed an event that is set if the lease
+        is lost, so long running work can stop early
+        """
+        while True:
+            items = list_items()
+            remaining = [i for i in sorted(items) if not self.is_finished(i)]
+            if not remaining:
+                print(f"{self.owner}: nothing left to do in {self.queue_dir.name}")
+                return
+
+            processed = False
+            for item in remaining:
+                lease = self.try_acquire(item)
+                if lease is None:
+                    continue
+                processed = True
+                print(f"{self.owner}: processing {item}")
+                try:
+                    process(items[item], lease.lost)
+                except Exception: # pylint: disable=broad-except
+                    if lease.lost.is_set():
+                        self.discard(item, lease)
+                        continue
+                    print(f"{self.owner}: {item} failed")
+                    self.fail(item, lease, traceback.format_exc())
+                else:
+                    if lease.lost.is_set():
+                        self.discard(item, lease)
+                    else:
+                        self.complete(item, lease)
+
+            if not processed:
+                time.sleep(POLL_INTERVAL)
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A pipeline stage that can be shared between workers
+    """
+    list_items: Callable[[PipelinePaths], Dict[str, Any]]
+    process: Callable[[PipelinePaths, Any, threading.Event], None]
+
+def list_source_episodes(paths: PipelinePaths) -> Dict[str, Any]:
+    """
+    Returns the episodes in Episodes.csv, keyed by the name of their mediainfo directory
+    """
+    import extract_attachments
+    return {e.episode_path.name: e for e in extract_attachments.load_episodes(paths)}
+
+def list_episode_dirs(paths: PipelinePaths) -> Dict[str, Any]:
+    """
+    Returns the mediainfo directories of episodes that have had attachments extracted
+    """
+    import process_subs
+    return {d.name: d for d in process_subs.get_episode_dirs(paths)}
+
+def extract_attachments_item(_: PipelinePaths, episode_info: Any, __: threading.Event):
+    """
+    Runs extract_attachments.py for one episode
+    """
+    import extract_attachments
+    extract_attachments.process_episode(episode_info)
+
+def process_subs_item(_: PipelinePaths, episode_dir: Path, __: threading.Event):
+    """
+    Runs process_subs.py for one episode
+    """
+    import process_subs
+    process_subs.process_episode(episode_dir)
+
+def grab_frames_item(paths: PipelinePaths, episode_dir: Path, stop: threading.Event):
+    """
+    Runs grab_frames.py for one episode, stopping early if the lease is lost
+    """
+    import grab_frames
+    grab_frames.process_episode(episode_dir, paths, stop)
+
+STAGES = {
+    "extract-attachments": Stage(list_source_episodes, extract_attachments_item),
+    "process-subs": Stage(list_episode_dirs, process_subs_item),
+    "grab-frames": Stage(list_episode_dirs, grab_frames_item),
+}
+
+def run_worker(stage_name: str, paths: PipelinePaths):
+    """
+    Works through a stage's episodes until none are left
+    """
+    stage = STAGES[stage_name]
+    queue = WorkQueue(paths.queue / stage_name)
+    queue.run(lambda: stage.list_items(paths), lambda item, stop: stage.process(paths, item, stop))
+
+def run_workers(stage_name: str, paths: PipelinePaths, worker_count: int = 1):
+    """
+    Runs a number of workers for a stage on this machine, each in its own process
+    """
+    if worker_count == 1:
+        run_worker(stage_name, paths)
+        return
+
+    workers = [Process(target=run_worker, args=(stage_name, paths)) for _ in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    import gatari
+    gatari.main(names=["worker"], description="Works through the episodes of a stage, sharing them with other workers")